@@ -4,16 +4,43 @@ Streamlit-based UI for PDF chatbot
 """
 
 import os
+import queue
+import hashlib
+import threading
+import httpx
+from typing import Iterator
 import streamlit as st
 from langchain_openai import ChatOpenAI
+from langchain_core.callbacks import BaseCallbackHandler
 from langchain.chains import ConversationalRetrievalChain
-from langchain.memory import ConversationBufferMemory
-from pdf_processor import PDFProcessor
+from langchain.memory import ConversationSummaryBufferMemory
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain.retrievers.document_compressors import CrossEncoderReranker
+from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+from pdf_processor import PDFProcessor, hash_pdf
+from retriever import HybridRetriever, build_bm25_retriever
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
+# Retrieval settings: fetch a wide candidate set from dense and keyword search,
+# then rerank down to what the LLM sees
+RERANKER_MODEL = "BAAI/bge-reranker-base"
+RETRIEVAL_CANDIDATES = 20
+# Each search fetches half, so the reranker scores about RETRIEVAL_CANDIDATES chunks
+RETRIEVAL_CANDIDATES_PER_SEARCH = RETRIEVAL_CANDIDATES // 2
+RETRIEVAL_TOP_N = 3
+
+# Number of most recent chat messages rendered on each rerun
+VISIBLE_MESSAGES = 30
+
+# Limits on what the session keeps, so long sessions don't grow without bound
+SOURCE_TEXT_LIMIT = 300
+MAX_MESSAGES = 400  # 200 question/answer turns
+MAX_HISTORY_CHARS = 10_000_000
+TRIMMED_MESSAGES = 50
+
 # Page configuration
 st.set_page_config(
     page_title="PDF Chatbot - Gen AI",
@@ -32,35 +59,90 @@ if "pdf_processed" not in st.session_state:
     st.session_state.pdf_processed = False
 
 
+@st.cache_resource(show_spinner=False)
+def get_http_client() -> httpx.Client:
+    """Shared HTTP/2 connection pool for all OpenAI chat and embedding calls"""
+    return httpx.Client(http2=True, limits=httpx.Limits(max_connections=32))
+
+
+@st.cache_resource(show_spinner=False)
+def load_reranker() -> HuggingFaceCrossEncoder:
+    """Load the cross-encoder once per server process; it is slow to initialize"""
+    return HuggingFaceCrossEncoder(model_name=RERANKER_MODEL)
+
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_index(pdf_hash: str, _api_key: str, _pdf_path: str):
+    """Build or load the vector store and BM25 index once per PDF version"""
+    # Underscore-prefixed arguments are excluded from the cache key, so the raw key is never hashed
+    processor = PDFProcessor(_pdf_path, http_client=get_http_client())
+    vector_store = processor.process_pdf(api_key=_api_key)
+    bm25_retriever = build_bm25_retriever(vector_store, k=RETRIEVAL_CANDIDATES_PER_SEARCH)
+    return processor, bm25_retriever
+
+
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_llms(api_key_hash: str, model_name: str, _api_key: str):
+    """Build the chat LLMs, cached by hashed API key and model"""
+    http_client = get_http_client()
+    llm = ChatOpenAI(
+        model_name=model_name,
+        temperature=0.7,
+        openai_api_key=_api_key,
+        http_client=http_client
+    )
+    # Separate streaming LLM for answers, so question rephrasing and memory
+    # summaries never leak tokens into the chat output
+    streaming_llm = ChatOpenAI(
+        model_name=model_name,
+        temperature=0.7,
+        openai_api_key=_api_key,
+        http_client=http_client,
+        streaming=True
+    )
+    return llm, streaming_llm
+
+
 def initialize_chatbot(api_key: str, pdf_path: str, model_name: str = "gpt-3.5-turbo"):
     """Initialize the chatbot with PDF processing"""
     try:
         with st.spinner("Processing PDF and setting up chatbot..."):
-            # Process PDF
-            processor = PDFProcessor(pdf_path)
-            vector_store = processor.process_pdf(api_key=api_key)
+            # Process PDF once per version; switching models reuses the index
+            processor, bm25_retriever = load_index(hash_pdf(pdf_path), api_key, pdf_path)
+            # Open the shared store with this session's key for query embeddings
+            vector_store = processor.load_vector_store(api_key)
             
-            # Initialize LLM
-            llm = ChatOpenAI(
-                model_name=model_name,
-                temperature=0.7,
-                openai_api_key=api_key
-            )
+            api_key_hash = hashlib.sha256(api_key.encode()).hexdigest()
+            llm, streaming_llm = load_llms(api_key_hash, model_name, api_key)
             
-            # Initialize memory
-            memory = ConversationBufferMemory(
+            # Initialize memory per session; older turns are folded into a running summary
+            memory = ConversationSummaryBufferMemory(
+                llm=llm,
+                max_token_limit=1000,
                 memory_key="chat_history",
                 return_messages=True,
                 output_key="answer"
             )
             
+            # Retrieve candidates by vector similarity and BM25, then rerank with the cross-encoder
+            retriever = ContextualCompressionRetriever(
+                base_compressor=CrossEncoderReranker(
+                    model=load_reranker(),
+                    top_n=RETRIEVAL_TOP_N
+                ),
+                base_retriever=HybridRetriever(
+                    vector_store=vector_store,
+                    bm25_retriever=bm25_retriever,
+                    k=RETRIEVAL_CANDIDATES_PER_SEARCH,
+                    max_results=RETRIEVAL_CANDIDATES
+                )
+            )
+            
             # Create retrieval chain
             chain = ConversationalRetrievalChain.from_llm(
-                llm=llm,
-                retriever=vector_store.as_retriever(
-                    search_type="similarity",
-                    search_kwargs={"k": 3}
-                ),
+                llm=streaming_llm,
+                condense_question_llm=llm,
+                retriever=retriever,
                 memory=memory,
                 return_source_documents=True,
                 verbose=False
@@ -76,6 +158,68 @@ def initialize_chatbot(api_key: str, pdf_path: str, model_name: str = "gpt-3.5-t
         return False
 
 
+class QueueCallbackHandler(BaseCallbackHandler):
+    """Forward streamed LLM tokens to a queue"""
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+    
+    def on_llm_new_token(self, token: str, **kwargs):
+        self.queue.put(token)
+
+
+def stream_answer(chain, question: str, response: dict) -> Iterator[str]:
+    """Run the chain in a worker thread, yielding answer tokens as they arrive.
+    
+    The full chain output is stored in `response` once the stream is exhausted.
+    """
+    handler = QueueCallbackHandler()
+    
+    def run():
+        try:
+            response.update(chain.invoke({"question": question}, config={"callbacks": [handler]}))
+        except Exception as e:
+            response["error"] = e
+        finally:
+            handler.queue.put(None)
+    
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while (token := handler.queue.get()) is not None:
+        yield token
+    thread.join()
+    if "error" in response:
+        raise response["error"]
+
+
+def history_size(messages: list) -> int:
+    """Approximate the size of the chat history in characters"""
+    return sum(
+        len(message.get("content", ""))
+        + sum(len(source["page_content"]) for source in message.get("sources", []))
+        for message in messages
+    )
+
+
+def add_message(message: dict):
+    """Append a chat message, trimming the oldest history when it grows too large"""
+    st.session_state.messages.append(message)
+    if len(st.session_state.messages) > MAX_MESSAGES:
+        st.session_state.messages = st.session_state.messages[-MAX_MESSAGES:]
+    if history_size(st.session_state.messages) > MAX_HISTORY_CHARS:
+        st.session_state.messages = st.session_state.messages[-TRIMMED_MESSAGES:]
+
+
+def render_message(message: dict):
+    """Render a stored chat message with its sources"""
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        if "sources" in message and message["sources"]:
+            with st.expander("📄 View Sources"):
+                for i, source in enumerate(message["sources"], 1):
+                    st.text(f"Source {i} (page {source['page'] or '?'}): {source['page_content'][:200]}...")
+
+
 def main():
     st.title("🤖 PDF Chatbot with Gen AI")
     st.markdown("Ask questions about the PDF document using AI-powered chat")
@@ -146,51 +290,54 @@ def main():
         5. Start asking questions!
         """)
     else:
-        # Display chat messages
-        for message in st.session_state.messages:
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-                if "sources" in message and message["sources"]:
-                    with st.expander("📄 View Sources"):
-                        for i, source in enumerate(message["sources"], 1):
-                            st.text(f"Source {i}: {source.page_content[:200]}...")
+        # Display chat messages; older ones are only rendered on request
+        earlier = st.session_state.messages[:-VISIBLE_MESSAGES]
+        if earlier and st.checkbox(f"Show {len(earlier)} earlier messages"):
+            for message in earlier:
+                render_message(message)
+        for message in st.session_state.messages[-VISIBLE_MESSAGES:]:
+            render_message(message)
         
         # Chat input
         if prompt := st.chat_input("Ask a question about the PDF..."):
             # Add user message
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            add_message({"role": "user", "content": prompt})
             with st.chat_message("user"):
                 st.markdown(prompt)
             
             # Get AI response
             with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    try:
-                        response = st.session_state.chain.invoke({"question": prompt})
-                        answer = response["answer"]
-                        sources = response.get("source_documents", [])
-                        
-                        st.markdown(answer)
-                        
-                        # Show sources
-                        if sources:
-                            with st.expander("📄 View Sources"):
-                                for i, source in enumerate(sources, 1):
-                                    st.text(f"Source {i}: {source.page_content[:300]}...")
-                        
-                        # Add assistant message
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": answer,
-                            "sources": sources
-                        })
-                    except Exception as e:
-                        error_msg = f"Error: {str(e)}"
-                        st.error(error_msg)
-                        st.session_state.messages.append({
-                            "role": "assistant",
-                            "content": error_msg
-                        })
+                try:
+                    response = {}
+                    st.write_stream(stream_answer(st.session_state.chain, prompt, response))
+                    answer = response["answer"]
+                    sources = response.get("source_documents", [])
+                    
+                    # Show sources
+                    if sources:
+                        with st.expander("📄 View Sources"):
+                            for i, source in enumerate(sources, 1):
+                                st.text(f"Source {i} (page {source.metadata.get('page', '?')}): {source.page_content[:SOURCE_TEXT_LIMIT]}...")
+                    
+                    # Add assistant message, keeping only a short excerpt of each source
+                    add_message({
+                        "role": "assistant",
+                        "content": answer,
+                        "sources": [
+                            {
+                                "page_content": source.page_content[:SOURCE_TEXT_LIMIT],
+                                "page": source.metadata.get("page")
+                            }
+                            for source in sources
+                        ]
+                    })
+                except Exception as e:
+                    error_msg = f"Error: {str(e)}"
+                    st.error(error_msg)
+                    add_message({
+                        "role": "assistant",
+                        "content": error_msg
+                    })
 
 
 if __name__ == "__main__":
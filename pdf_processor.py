@@ -4,91 +4,558 @@ Handles PDF text extraction and vector store creation
 """
 
 import os
-from typing import List
-from PyPDF2 import PdfReader
+import re
+import json
+import shutil
+import asyncio
+import uuid
+import queue
+import threading
+import multiprocessing
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from hashlib import blake2b
+from typing import ClassVar, Iterable, Iterator, List, Optional, Tuple
+import chromadb
+import httpx
+import pypdfium2 as pdfium
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
 from langchain_openai import OpenAIEmbeddings
 from langchain_core.documents import Document
 
 
+EMBEDDING_MODEL = "text-embedding-3-small"
+# Reduced output size; 512 dimensions keep retrieval quality close to the full 1536
+EMBEDDING_DIMENSIONS = 512
+BATCH_SIZE = 128
+# Number of embedding batches requested from OpenAI concurrently
+CONCURRENT_BATCHES = 8
+# Chunks buffered between the extraction thread and the embedder
+QUEUE_SIZE = 64
+# Pages extracted per worker task; small ranges let early pages reach the embedder
+# while later ones are still being extracted
+PAGES_PER_TASK = 8
+COLLECTION_NAME = "langchain"
+QUERY_CACHE_SIZE = 1024
+# HNSW index settings: cosine distance with a denser graph for better recall
+HNSW_CONFIG = {
+    "hnsw:space": "cosine",
+    "hnsw:M": 32,
+    "hnsw:construction_ef": 200,
+    "hnsw:search_ef": 128,
+}
+MANIFEST_FILE = "manifest.json"
+# Bump when the stored chunk text or metadata layout changes
+STORE_VERSION = 5
+
+# Page text cleanup: form feeds become spaces, soft hyphens and carriage returns
+# are dropped, and runs of spaces or tabs collapse to one space
+_TABLE = str.maketrans({"\x0c": " ", "\u00ad": "", "\r": ""})
+_WS_RE = re.compile(r"[ \t]{2,}")
+
+
+def hash_pdf(pdf_path: str) -> str:
+    """Compute a BLAKE2b digest of the PDF file contents"""
+    digest = blake2b(digest_size=16)
+    with open(pdf_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def clean_text(text: str) -> str:
+    """Strip extraction artifacts that would otherwise bloat chunks"""
+    return _WS_RE.sub(" ", text.translate(_TABLE))
+
+
+# Store directories opened by this process. chromadb caches one system per path
+# for the life of the process, so an opened path must never be deleted and reused.
+_OPEN_STORES = set()
+
+
+def open_store_client(directory: str):
+    """Open a persistent Chroma client, remembering that this process holds the store"""
+    _OPEN_STORES.add(os.path.abspath(directory))
+    return chromadb.PersistentClient(path=directory)
+
+
+def hash_text(text: str) -> str:
+    """Compute a BLAKE2b digest of a page's text"""
+    return blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class CachedOpenAIEmbeddings(OpenAIEmbeddings):
+    """OpenAI embeddings that keep an LRU cache of recent query vectors"""
+    
+    # Shared across instances so the cache survives chatbot re-initialization
+    _query_cache: ClassVar["OrderedDict[Tuple[str, Optional[int], str], List[float]]"] = OrderedDict()
+    _query_lock: ClassVar[threading.Lock] = threading.Lock()
+    
+    def _cache_key(self, text: str) -> Tuple[str, Optional[int], str]:
+        return self.model, self.dimensions, text
+    
+    def _cache_get(self, key: Tuple[str, Optional[int], str]):
+        with self._query_lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+        return None
+    
+    def _cache_put(self, key: Tuple[str, Optional[int], str], vector: List[float]):
+        with self._query_lock:
+            self._query_cache[key] = vector
+            if len(self._query_cache) > QUERY_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+    
+    def embed_query(self, text: str) -> List[float]:
+        # Normalize so whitespace and case variants of a question share an entry
+        text = text.strip().lower()
+        key = self._cache_key(text)
+        vector = self._cache_get(key)
+        if vector is None:
+            vector = super().embed_query(text)
+            self._cache_put(key, vector)
+        return vector
+    
+    async def aembed_query(self, text: str) -> List[float]:
+        text = text.strip().lower()
+        key = self._cache_key(text)
+        vector = self._cache_get(key)
+        if vector is None:
+            vector = await super().aembed_query(text)
+            self._cache_put(key, vector)
+        return vector
+
+
+def _extract_range(pdf_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """Extract (page number, text) for pages [start, end) in a worker process"""
+    # PDFium documents can't be pickled, so each worker opens its own
+    pdf = pdfium.PdfDocument(pdf_path)
+    pages: List[Tuple[int, str]] = []
+    try:
+        for page_num in range(start, end):
+            page = pdf[page_num]
+            textpage = page.get_textpage()
+            pages.append((page_num + 1, clean_text(textpage.get_text_range())))
+            textpage.close()
+            page.close()
+    finally:
+        pdf.close()
+    return pages
+
+
 class PDFProcessor:
-    def __init__(self, pdf_path: str, persist_directory: str = "./chroma_db"):
+    def __init__(self, pdf_path: str, persist_directory: str = "./chroma_db", http_client: Optional[httpx.Client] = None):
         self.pdf_path = pdf_path
-        self.persist_directory = persist_directory
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
+        # Optional shared connection pool for OpenAI requests
+        self.http_client = http_client
+        self.pdf_hash = hash_pdf(pdf_path)
+        # Each build of a PDF gets its own store under the root, found via its manifest,
+        # so swapping files never returns stale embeddings
+        self.store_root = persist_directory
+        self.persist_directory = None
+        # Chunk sizes are measured in embedding-model tokens, not characters
+        self.chunk_size = 400
+        self.chunk_overlap = 60
+        self.embedding_model = EMBEDDING_MODEL
+        self.embedding_dimensions = EMBEDDING_DIMENSIONS
+        self.text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+            model_name=self.embedding_model,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
         )
+
+    @property
+    def manifest_path(self) -> str:
+        return os.path.join(self.persist_directory, MANIFEST_FILE)
+
+    def build_manifest(self) -> dict:
+        """Describe the settings the vector store was built with"""
+        return {
+            "version": STORE_VERSION,
+            "pdf_hash": self.pdf_hash,
+            "source": os.path.abspath(self.pdf_path),
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "length_unit": "tokens",
+            "embedding_model": self.embedding_model,
+            "embedding_dimensions": self.embedding_dimensions,
+            "index": HNSW_CONFIG,
+        }
+
+    def write_manifest(self):
+        """Store the build settings alongside the vector store"""
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.build_manifest(), f, indent=2)
+
+    def read_manifest(self, store_directory: str) -> Optional[dict]:
+        """Read the manifest of a vector store, or None if it is missing or invalid"""
+        try:
+            with open(os.path.join(store_directory, MANIFEST_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def settings_match(self, manifest: Optional[dict]) -> bool:
+        """Check whether a manifest was written with the current chunking and embedding settings"""
+        if not manifest:
+            return False
+        current = self.build_manifest()
+        return all(
+            manifest.get(key) == value
+            for key, value in current.items()
+            if key not in ("pdf_hash", "source")
+        )
+
+    def new_store_directory(self) -> str:
+        """Pick a fresh directory for a build, so a failed one can be discarded and retried"""
+        return os.path.join(self.store_root, f"{self.pdf_hash}-{uuid.uuid4().hex[:8]}")
+
+    def list_stores(self) -> List[Tuple[str, Optional[dict]]]:
+        """List store directories under the root with their manifests (None if incomplete)"""
+        if not os.path.isdir(self.store_root):
+            return []
+        return [
+            (directory, self.read_manifest(directory))
+            for directory in (os.path.join(self.store_root, name) for name in os.listdir(self.store_root))
+            if os.path.isdir(directory)
+        ]
+
+    def newest_store(self, directories: List[str]) -> Optional[str]:
+        return max(directories, key=lambda d: os.path.getmtime(os.path.join(d, MANIFEST_FILE)), default=None)
+
+    def find_current_store(self) -> Optional[str]:
+        """Find the most recent store built from this PDF with current settings"""
+        return self.newest_store([
+            directory for directory, manifest in self.list_stores()
+            if self.settings_match(manifest) and manifest.get("pdf_hash") == self.pdf_hash
+        ])
+
+    def find_previous_store(self) -> Optional[str]:
+        """Find the most recent store built from an earlier version of this PDF"""
+        source = os.path.abspath(self.pdf_path)
+        return self.newest_store([
+            directory for directory, manifest in self.list_stores()
+            if self.settings_match(manifest)
+            and manifest.get("source") == source
+            and manifest.get("pdf_hash") != self.pdf_hash
+        ])
+
+    def remove_stale_stores(self):
+        """Delete superseded stores of this PDF, including earlier versions of the file.
         
-    def extract_text_from_pdf(self) -> str:
-        """Extract text from PDF file"""
+        Stores this process has opened are kept; they may still back cached sessions
+        and are removed by a later run instead.
+        """
+        source = os.path.abspath(self.pdf_path)
+        for directory, manifest in self.list_stores():
+            if os.path.abspath(directory) in _OPEN_STORES:
+                continue
+            manifest = manifest or {}
+            if (os.path.basename(directory).startswith(self.pdf_hash)
+                    or manifest.get("pdf_hash") == self.pdf_hash
+                    or manifest.get("source") == source):
+                shutil.rmtree(directory, ignore_errors=True)
+
+    def iter_pages(self) -> Iterator[Tuple[int, str]]:
+        """Yield (page number, text) for each PDF page in order"""
+        pdf = pdfium.PdfDocument(self.pdf_path)
+        num_pages = len(pdf)
+        pdf.close()
+        
+        workers = max(1, min((os.cpu_count() or 2) - 1, num_pages))
+        ranges = [(start, min(start + PAGES_PER_TASK, num_pages)) for start in range(0, num_pages, PAGES_PER_TASK)]
+        
+        # Spawn rather than fork: the Streamlit server is multi-threaded and may have
+        # torch loaded, and forking a threaded process can deadlock the children
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            # Keep a bounded window of ranges in flight and yield them in page order,
+            # so finished-but-unconsumed text never holds the whole PDF in memory
+            pending = deque()
+            for start, end in ranges:
+                pending.append(executor.submit(_extract_range, self.pdf_path, start, end))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    
+    def extract_text_from_pdf(self) -> List[Tuple[int, str]]:
+        """Extract (page number, text) pairs from PDF file"""
         print(f"Extracting text from {self.pdf_path}...")
-        reader = PdfReader(self.pdf_path)
-        text = ""
-        for page_num, page in enumerate(reader.pages):
-            text += f"\n--- Page {page_num + 1} ---\n"
-            text += page.extract_text()
-        print(f"Extracted {len(text)} characters from PDF")
-        return text
-    
-    def create_documents(self, text: str) -> List[Document]:
-        """Split text into chunks and create Document objects"""
+        pages = list(self.iter_pages())
+        print(f"Extracted {sum(len(text) for _, text in pages)} characters from PDF")
+        return pages
+    
+    def split_page(self, page_num: int, text: str) -> List[Document]:
+        """Split one page into chunks, keeping the page number and content hash in metadata"""
+        metadata = {"page": page_num, "source": self.pdf_path, "page_hash": hash_text(text)}
+        return [
+            Document(page_content=chunk, metadata=dict(metadata))
+            for chunk in self.text_splitter.split_text(text)
+        ]
+    
+    def create_documents(self, pages: Iterable[Tuple[int, str]]) -> List[Document]:
+        """Split pages into chunks and create Document objects"""
         print("Splitting text into chunks...")
-        chunks = self.text_splitter.split_text(text)
-        documents = [Document(page_content=chunk) for chunk in chunks]
+        documents = [doc for page_num, text in pages for doc in self.split_page(page_num, text)]
         print(f"Created {len(documents)} document chunks")
         return documents
     
-    def create_vector_store(self, documents: List[Document], api_key: str = None) -> Chroma:
-        """Create and persist vector store from documents"""
-        print("Creating vector store...")
+    def iter_documents(self) -> Iterator[Document]:
+        """Extract and split the PDF page by page, yielding chunks as they are produced"""
+        print(f"Extracting and splitting {self.pdf_path}...")
+        for page_num, text in self.iter_pages():
+            yield from self.split_page(page_num, text)
+    
+    def produce_documents(self, documents: Iterable[Document], docs_queue: queue.Queue, errors: list, stop: threading.Event):
+        """Feed documents into the queue from a background thread, ending with None"""
+        try:
+            for doc in documents:
+                # Poll so the producer can give up once the consumer has stopped reading
+                while not stop.is_set():
+                    try:
+                        docs_queue.put(doc, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+        except Exception as e:
+            errors.append(e)
+        finally:
+            if hasattr(documents, "close"):
+                documents.close()
+            if not stop.is_set():
+                docs_queue.put(None)
+    
+    async def ingest_documents(self, documents: Iterable[Document], embeddings: OpenAIEmbeddings, collection) -> int:
+        """Embed and store documents as they are produced, overlapping extraction and embedding"""
+        docs_queue = queue.Queue(maxsize=QUEUE_SIZE)
+        errors = []
+        stop = threading.Event()
+        threading.Thread(
+            target=self.produce_documents,
+            args=(documents, docs_queue, errors, stop),
+            daemon=True
+        ).start()
         
-        # Initialize embeddings
+        loop = asyncio.get_running_loop()
+        in_flight = asyncio.Semaphore(CONCURRENT_BATCHES)
+        # Chroma writes go through a single writer thread so disk I/O never blocks
+        # the event loop while other embedding requests are in flight
+        writer = ThreadPoolExecutor(max_workers=1)
+        
+        async def embed_and_store(batch: List[Document]):
+            try:
+                vectors = await embeddings.aembed_documents([doc.page_content for doc in batch])
+                metadatas = [doc.metadata for doc in batch]
+                await loop.run_in_executor(writer, partial(
+                    collection.add,
+                    ids=[str(uuid.uuid4()) for _ in batch],
+                    embeddings=vectors,
+                    documents=[doc.page_content for doc in batch],
+                    metadatas=metadatas if all(metadatas) else None
+                ))
+            finally:
+                in_flight.release()
+        
+        tasks = []
+        batch: List[Document] = []
+        count = 0
+        try:
+            while True:
+                # Stop at the first failed batch instead of sending the rest of the PDF
+                for task in tasks:
+                    if task.done() and task.exception():
+                        raise task.exception()
+                
+                doc = await loop.run_in_executor(None, docs_queue.get)
+                if doc is None and errors:
+                    raise errors[0]
+                if doc is not None:
+                    batch.append(doc)
+                # Dispatch full batches immediately; waiting on the semaphore applies backpressure
+                if batch and (doc is None or len(batch) == BATCH_SIZE):
+                    await in_flight.acquire()
+                    tasks.append(asyncio.create_task(embed_and_store(batch)))
+                    count += len(batch)
+                    batch = []
+                if doc is None:
+                    break
+            
+            await asyncio.gather(*tasks)
+        except BaseException:
+            stop.set()
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            # Callers may delete the store on failure, so no write can still be running
+            writer.shutdown(wait=True)
+        return count
+    
+    def create_embeddings(self, api_key: str = None) -> CachedOpenAIEmbeddings:
+        """Initialize the embedding model used for both ingest and queries"""
         if api_key:
             os.environ["OPENAI_API_KEY"] = api_key
-        embeddings = OpenAIEmbeddings()
+        return CachedOpenAIEmbeddings(
+            model=self.embedding_model,
+            dimensions=self.embedding_dimensions,
+            chunk_size=BATCH_SIZE,
+            max_retries=6,
+            http_client=self.http_client
+        )
+    
+    def create_vector_store(self, documents: Iterable[Document], api_key: str = None) -> Chroma:
+        """Create and persist vector store from documents, embedding them while they are extracted"""
+        print("Creating vector store...")
+        embeddings = self.create_embeddings(api_key)
+        
+        client = open_store_client(self.persist_directory)
+        collection = client.get_or_create_collection(COLLECTION_NAME, metadata=HNSW_CONFIG)
         
-        # Create vector store
-        vector_store = Chroma.from_documents(
-            documents=documents,
-            embedding=embeddings,
-            persist_directory=self.persist_directory
+        count = asyncio.run(self.ingest_documents(documents, embeddings, collection))
+        if not count:
+            raise ValueError(f"No text could be extracted from {self.pdf_path}")
+        
+        vector_store = Chroma(
+            client=client,
+            collection_name=COLLECTION_NAME,
+            embedding_function=embeddings
         )
+        self.write_manifest()
         
-        print(f"Vector store created and persisted to {self.persist_directory}")
+        print(f"Vector store created from {count} chunks and persisted to {self.persist_directory}")
         return vector_store
     
     def load_vector_store(self, api_key: str = None) -> Chroma:
         """Load existing vector store"""
-        if api_key:
-            os.environ["OPENAI_API_KEY"] = api_key
-        embeddings = OpenAIEmbeddings()
+        embeddings = self.create_embeddings(api_key)
         
-        if os.path.exists(self.persist_directory):
+        if self.persist_directory and os.path.exists(self.persist_directory):
             print(f"Loading existing vector store from {self.persist_directory}...")
             vector_store = Chroma(
-                persist_directory=self.persist_directory,
+                client=open_store_client(self.persist_directory),
+                collection_name=COLLECTION_NAME,
                 embedding_function=embeddings
             )
             return vector_store
         else:
             raise FileNotFoundError(f"Vector store not found at {self.persist_directory}")
     
+    def update_vector_store(self, previous_directory: str, api_key: str = None) -> Chroma:
+        """Update a copy of an earlier store, embedding only pages whose content changed"""
+        print(f"Updating vector store from {previous_directory}...")
+        shutil.copytree(previous_directory, self.persist_directory)
+        # The copy is not valid for this PDF until the update completes
+        os.remove(self.manifest_path)
+        
+        embeddings = self.create_embeddings(api_key)
+        client = open_store_client(self.persist_directory)
+        collection = client.get_collection(COLLECTION_NAME)
+        
+        # Stored chunk ids grouped by page content hash, then by the page they were on
+        stored_pages = {}
+        stored = collection.get(include=["metadatas"])
+        for chunk_id, metadata in zip(stored["ids"], stored["metadatas"]):
+            pages = stored_pages.setdefault(metadata["page_hash"], {})
+            pages.setdefault(metadata["page"], []).append(chunk_id)
+        
+        # Extract pages; identical pages share a hash, so keep every page number per hash.
+        # The text is kept only for hashes that may need embedding, and the expected
+        # chunks of a full rebuild are counted to check the result.
+        current_pages = {}
+        page_texts = {}
+        expected = Counter()
+        for page_num, text in self.iter_pages():
+            page_hash = hash_text(text)
+            current_pages.setdefault(page_hash, []).append(page_num)
+            expected[(page_num, page_hash)] += len(self.text_splitter.split_text(text))
+            if len(current_pages[page_hash]) > len(stored_pages.get(page_hash, {})):
+                page_texts[page_hash] = text
+        
+        removed_ids, moved_ids, moved_metadatas, new_pages = [], [], [], []
+        for page_hash in stored_pages.keys() | current_pages.keys():
+            stored_by_page = stored_pages.get(page_hash, {})
+            current = current_pages.get(page_hash, [])
+            # Occurrences already on the right page stay as they are
+            unmatched_stored = [page for page in sorted(stored_by_page) if page not in current]
+            unmatched_current = [page for page in current if page not in stored_by_page]
+            # Remaining stored copies shift to the remaining pages without re-embedding
+            for old_page, new_page in zip(unmatched_stored, unmatched_current):
+                for chunk_id in stored_by_page[old_page]:
+                    moved_ids.append(chunk_id)
+                    moved_metadatas.append({"page": new_page, "source": self.pdf_path, "page_hash": page_hash})
+            # Extra stored copies are deleted; extra occurrences are embedded
+            for old_page in unmatched_stored[len(unmatched_current):]:
+                removed_ids.extend(stored_by_page[old_page])
+            for new_page in unmatched_current[len(unmatched_stored):]:
+                new_pages.append((new_page, page_texts[page_hash]))
+        
+        if removed_ids:
+            collection.delete(ids=removed_ids)
+        if moved_ids:
+            collection.update(ids=moved_ids, metadatas=moved_metadatas)
+        
+        new_pages.sort()
+        documents = (doc for page_num, text in new_pages for doc in self.split_page(page_num, text))
+        added = asyncio.run(self.ingest_documents(documents, embeddings, collection))
+        
+        # The update must leave the same chunks per page as a full rebuild would
+        updated = collection.get(include=["metadatas"])["metadatas"]
+        if Counter((metadata["page"], metadata["page_hash"]) for metadata in updated) != +expected:
+            raise ValueError("Incremental update does not match a full rebuild")
+        
+        vector_store = Chroma(
+            client=client,
+            collection_name=COLLECTION_NAME,
+            embedding_function=embeddings
+        )
+        self.write_manifest()
+        
+        print(f"Vector store updated: {len(new_pages)} new pages ({added} chunks), "
+              f"{len(removed_ids)} removed chunks, {len(moved_ids)} renumbered chunks")
+        return vector_store
+    
     def process_pdf(self, api_key: str = None, force_reprocess: bool = False) -> Chroma:
         """Main method to process PDF and create/load vector store"""
-        # Check if vector store already exists
-        if not force_reprocess and os.path.exists(self.persist_directory):
-            try:
-                return self.load_vector_store(api_key)
-            except Exception as e:
-                print(f"Error loading vector store: {e}. Reprocessing PDF...")
+        if not force_reprocess:
+            # Reuse the vector store only if it was built from this PDF with the same settings
+            current_directory = self.find_current_store()
+            if current_directory:
+                self.persist_directory = current_directory
+                try:
+                    vector_store = self.load_vector_store(api_key)
+                    self.remove_stale_stores()
+                    return vector_store
+                except Exception as e:
+                    print(f"Error loading vector store: {e}. Reprocessing PDF...")
+            
+            # Otherwise update a store built from an earlier version of the same PDF
+            previous_directory = self.find_previous_store()
+            if previous_directory:
+                self.persist_directory = self.new_store_directory()
+                try:
+                    vector_store = self.update_vector_store(previous_directory, api_key)
+                    self.remove_stale_stores()
+                    return vector_store
+                except Exception as e:
+                    print(f"Error updating vector store: {e}. Reprocessing PDF...")
+                    shutil.rmtree(self.persist_directory, ignore_errors=True)
         
-        # Process PDF
-        text = self.extract_text_from_pdf()
-        documents = self.create_documents(text)
-        vector_store = self.create_vector_store(documents, api_key)
+        # Process PDF into a fresh directory; a failed build is discarded, never reused
+        self.persist_directory = self.new_store_directory()
+        try:
+            vector_store = self.create_vector_store(self.iter_documents(), api_key)
+        except Exception:
+            shutil.rmtree(self.persist_directory, ignore_errors=True)
+            raise
+        self.remove_stale_stores()
         
         return vector_store
-
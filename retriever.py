@@ -0,0 +1,94 @@
+"""
+Hybrid Retrieval Module
+Combines dense vector search with BM25 keyword search
+"""
+
+import re
+import asyncio
+from typing import List, Optional
+from langchain_community.retrievers import BM25Retriever
+from langchain_community.vectorstores import Chroma
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+
+TOKEN_RE = re.compile(r"\w+")
+PAGE_RE = re.compile(r"\bpage\s+(\d+)\b", re.IGNORECASE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase word tokenizer for BM25"""
+    return TOKEN_RE.findall(text.lower())
+
+
+def build_bm25_retriever(vector_store: Chroma, k: int) -> BM25Retriever:
+    """Build a BM25 index over the chunks already stored in the vector store"""
+    stored = vector_store.get(include=["documents", "metadatas"])
+    return BM25Retriever.from_texts(
+        stored["documents"],
+        metadatas=[metadata or {} for metadata in stored["metadatas"]],
+        preprocess_func=tokenize,
+        k=k,
+    )
+
+
+class HybridRetriever(BaseRetriever):
+    """Run dense and BM25 retrieval in parallel and merge their results"""
+    
+    vector_store: Chroma
+    bm25_retriever: BM25Retriever
+    # Candidates fetched per search, and the cap on the merged list sent to the reranker
+    k: int = 10
+    max_results: int = 20
+    
+    def requested_page(self, query: str) -> Optional[int]:
+        """Return the page number mentioned in the query, if any"""
+        match = PAGE_RE.search(query)
+        return int(match.group(1)) if match else None
+    
+    def keyword_search(self, query: str, page: Optional[int] = None) -> List[Document]:
+        """BM25 search, or every chunk of the page when one is requested"""
+        if page is not None:
+            return [doc for doc in self.bm25_retriever.docs if doc.metadata.get("page") == page][:self.k]
+        return self.bm25_retriever.invoke(query)
+    
+    async def search(self, query: str) -> List[Document]:
+        loop = asyncio.get_running_loop()
+        searches = [
+            self.vector_store.asimilarity_search(query, k=self.k),
+            loop.run_in_executor(None, self.keyword_search, query),
+        ]
+        
+        # A named page may be empty or refer to the printed page number, so page
+        # matches are put first but the unfiltered candidates are always kept
+        page = self.requested_page(query)
+        if page is not None:
+            searches = [
+                self.vector_store.asimilarity_search(query, k=self.k, filter={"page": page}),
+                loop.run_in_executor(None, self.keyword_search, query, page),
+            ] + searches
+        
+        # Latency is the slowest search rather than their sum
+        results = await asyncio.gather(*searches)
+        
+        # Deduplicate chunks found by several searches, keeping the first occurrence,
+        # and cap the list so reranking cost stays fixed
+        unique = {}
+        for docs in results:
+            for doc in docs:
+                unique.setdefault(doc.page_content, doc)
+        return list(unique.values())[:self.max_results]
+    
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return asyncio.run(self.search(query))
+    
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        return await self.search(query)